@@ -1,20 +1,29 @@
 import os
+import json
+import signal
 import logging
 import random
 import asyncio
-from datetime import datetime, timedelta
+import time
+import contextvars
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import MongoClient, ReadPreference, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
+from telegram.helpers import escape_markdown
 from aiohttp import web
 
 # Load environment variables
@@ -39,6 +48,47 @@ CONFIG = {
     'channel_links': os.getenv('CHANNEL_LINKS', 'https://t.me/Freenethubz,https://t.me/Freeairtimehub,https://t.me/Freenethubchannel').split(',')
 }
 
+# Bot command whose handler is currently running, used to attribute MongoDB reads
+current_command = contextvars.ContextVar('current_command', default='other')
+# Handler group that runs before all command handlers and tags the update's command
+COMMAND_TAG_GROUP = -1
+MONGO_READ_COMMANDS = {'find', 'getMore', 'aggregate', 'count', 'distinct'}
+
+class MongoOpCounter(monitoring.CommandListener):
+    """Count MongoDB reads per bot command so read load per command can be measured"""
+
+    def __init__(self):
+        self.reads = Counter()
+        self.invocations = Counter()
+
+    def started(self, event):
+        # Listeners run synchronously in the calling thread, so the handler's context is visible here
+        if event.command_name in MONGO_READ_COMMANDS:
+            self.reads[current_command.get()] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+mongo_op_counter = MongoOpCounter()
+# Names of registered bot commands; anything else is counted as 'other' so users can't grow the counters
+registered_commands = set()
+
+async def tag_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Record which command an update runs so its MongoDB reads are attributed to it"""
+    command = 'other'
+    if update.message and update.message.text and update.message.text.startswith('/'):
+        name = update.message.text.split()[0][1:].split('@')[0].lower()
+        if name in registered_commands:
+            command = f"/{name}"
+    elif update.callback_query:
+        command = 'callback'
+    # Handler groups run sequentially in one task, so the value is seen by the command handler
+    current_command.set(command)
+    mongo_op_counter.invocations[command] += 1
+
 # MongoDB connection
 try:
     mongodb_uri = os.getenv('MONGODB_URI')
@@ -65,7 +115,9 @@ try:
         tlsAllowInvalidCertificates=False,
         connectTimeoutMS=30000,
         socketTimeoutMS=30000,
-        serverSelectionTimeoutMS=30000
+        serverSelectionTimeoutMS=30000,
+        tz_aware=True,
+        event_listeners=[mongo_op_counter]
     )
     
     # Test the connection immediately
@@ -85,15 +137,165 @@ feedback_collection = db['feedback']
 milestone_rewards_collection = db['milestone_rewards']
 transactions_collection = db['transactions']
 
+# Schema configuration
+# Version 2 stores timestamps as native BSON dates and omits unset optional fields
+SCHEMA_VERSION = 2
+FEEDBACK_RETENTION_DAYS = int(os.getenv('FEEDBACK_RETENTION_DAYS', 90))
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', 500))
+MIGRATION_BATCH_DELAY = float(os.getenv('MIGRATION_BATCH_DELAY', 0.2))
+# MongoDB error code for an existing index with the same keys but different options
+INDEX_OPTIONS_CONFLICT = 85
+
+# Timestamp fields per collection that were stored as isoformat() strings before version 2
+DATETIME_FIELDS = {
+    'users': ('last_active', 'join_date', 'referral_link_expiry'),
+    'referral_history': ('timestamp',),
+    'feedback': ('timestamp',),
+    'milestone_rewards': ('timestamp',),
+    'transactions': ('timestamp',),
+}
+
+# Reads that tolerate slight staleness (leaderboards) are served by secondaries when available
+users_secondary = users_collection.with_options(read_preference=ReadPreference.SECONDARY_PREFERRED)
+referral_history_secondary = referral_history_collection.with_options(
+    read_preference=ReadPreference.SECONDARY_PREFERRED
+)
+
+# === USER PROFILE CACHE ===
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 60))
+USER_PROFILE_PROJECTION = {'_id': 0, 'user_id': 1, 'username': 1, 'credits': 1, 'tier': 1, 'banned': 1, 'referrer_id': 1}
+
+class UserCache:
+    """Bounded LRU cache of projected user records with a per-entry TTL"""
+
+    MISSING = object()
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """Return the cached record or MISSING"""
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(user_id, None)
+            self.misses += 1
+            return self.MISSING
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def peek(self, user_id):
+        """Return the cached record without touching recency or hit-rate counters"""
+        entry = self.entries.get(user_id)
+        return entry[1] if entry else None
+
+    def put(self, user_id, record):
+        self.entries[user_id] = (time.monotonic() + self.ttl, record)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def update(self, user_id, **fields):
+        """Apply written fields to a cached record without extending its lifetime"""
+        entry = self.entries.get(user_id)
+        if entry:
+            entry[1].update(fields)
+
+    def invalidate(self, user_id):
+        self.entries.pop(user_id, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
 # Webhook configuration
 PORT = int(os.getenv('PORT', 10000))
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', '') + WEBHOOK_PATH
 
+# Withdrawal settlement configuration
+WITHDRAWAL_DIGEST_MINUTES = float(os.getenv('WITHDRAWAL_DIGEST_MINUTES', 60))
+WITHDRAWAL_LIST_LIMIT = 20
+REFUND_BATCH_SIZE = 1000
+# Delay between user notifications, keeps bulk sends under Telegram's ~30 messages/s limit
+NOTIFICATION_DELAY = 0.05
+
+# Update journal configuration
+JOURNAL_DIR = os.getenv('JOURNAL_DIR', 'journal')
+JOURNAL_SEGMENT_BYTES = int(os.getenv('JOURNAL_SEGMENT_BYTES', 4 * 1024 * 1024))
+# Handler group that runs after all command handlers and marks the update as processed
+JOURNAL_ACK_GROUP = 1
+
 # === DATABASE FUNCTIONS ===
+def utcnow():
+    """Current time as a timezone-aware UTC datetime"""
+    return datetime.now(timezone.utc)
+
+def as_datetime(value):
+    """Convert a stored timestamp to an aware datetime, accepting legacy isoformat() strings"""
+    if value is None or isinstance(value, datetime):
+        return value
+    parsed = datetime.fromisoformat(value)
+    # Legacy strings were written with datetime.now(), i.e. naive local time
+    return parsed.astimezone(timezone.utc)
+
+def ensure_indexes():
+    """Create the indexes the bot relies on"""
+    users_collection.create_index('user_id')
+    referral_history_collection.create_index('referrer_id')
+    transactions_collection.create_index('user_id')
+    # Pending queue: only unsettled transactions are indexed, so it stays small however large history grows
+    transactions_collection.create_index(
+        [('type', 1), ('status', 1), ('timestamp', 1)],
+        partialFilterExpression={'status': 'pending'}
+    )
+    transactions_collection.create_index('settlement_id', sparse=True)
+    transactions_collection.create_index(
+        [('type', 1), ('status', 1), ('refunded_at', 1)],
+        partialFilterExpression={'status': 'rejected'}
+    )
+    # Records written while handling an update carry its update_id so journal replays can't duplicate them
+    for collection in (transactions_collection, referral_history_collection):
+        collection.create_index(
+            'update_id',
+            unique=True,
+            partialFilterExpression={'update_id': {'$exists': True}}
+        )
+    try:
+        # TTL indexes only expire documents whose field is a BSON date
+        feedback_collection.create_index(
+            'timestamp',
+            expireAfterSeconds=FEEDBACK_RETENTION_DAYS * 24 * 3600
+        )
+    except OperationFailure as e:
+        if e.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        # An existing timestamp index with other options (or none) must be changed with collMod
+        db.command(
+            'collMod', feedback_collection.name,
+            index={'keyPattern': {'timestamp': 1}, 'expireAfterSeconds': FEEDBACK_RETENTION_DAYS * 24 * 3600}
+        )
+        logger.info(f"Updated feedback retention to {FEEDBACK_RETENTION_DAYS} days ({e})")
+
 def add_user(user, referrer_id=None):
     """Add user to database if not exists"""
+    now = utcnow()
     user_data = {
         'user_id': user.id,
         'username': user.username,
@@ -101,10 +303,9 @@ def add_user(user, referrer_id=None):
         'last_name': user.last_name,
         'credits': 0,
         'banned': False,
-        'referral_link_expiry': None,
-        'tier': None,
-        'last_active': datetime.now().isoformat(),
-        'join_date': datetime.now().isoformat()
+        'last_active': now,
+        'join_date': now,
+        'schema_version': SCHEMA_VERSION
     }
     
     if referrer_id:
@@ -115,21 +316,32 @@ def add_user(user, referrer_id=None):
         {'$setOnInsert': user_data},
         upsert=True
     )
+    user_cache.invalidate(user.id)
 
-def add_referral(referrer_id, referred_id):
-    """Add a referral record"""
-    referral_history_collection.insert_one({
+def add_referral(referrer_id, referred_id, update_id=None):
+    """Add a referral record, returns False if this update already recorded it"""
+    referral = {
         'referrer_id': referrer_id,
         'referred_id': referred_id,
-        'timestamp': datetime.now().isoformat()
-    })
+        'timestamp': utcnow()
+    }
+    if update_id is not None:
+        referral['update_id'] = update_id
+    try:
+        referral_history_collection.insert_one(referral)
+    except DuplicateKeyError:
+        return False
+    record = user_cache.peek(referrer_id)
+    if record and 'referral_count' in record:
+        record['referral_count'] += 1
+    return True
 
 def add_feedback(user_id, message):
     """Add feedback to database"""
     feedback_collection.insert_one({
         'user_id': user_id,
         'message': message,
-        'timestamp': datetime.now().isoformat()
+        'timestamp': utcnow()
     })
 
 def add_milestone_reward(user_id, milestone, reward):
@@ -138,7 +350,7 @@ def add_milestone_reward(user_id, milestone, reward):
         'user_id': user_id,
         'milestone': milestone,
         'reward': reward,
-        'timestamp': datetime.now().isoformat()
+        'timestamp': utcnow()
     })
 
 def add_transaction(user_id, transaction_type, amount, status='completed'):
@@ -148,28 +360,119 @@ def add_transaction(user_id, transaction_type, amount, status='completed'):
         'type': transaction_type,
         'amount': amount,
         'status': status,
-        'timestamp': datetime.now().isoformat()
+        'timestamp': utcnow()
     })
 
+def cache_user_record(user_id, record):
+    """Store a freshly written user projection, keeping the cached referral count"""
+    cached = user_cache.peek(user_id)
+    if cached and 'referral_count' in cached:
+        record['referral_count'] = cached['referral_count']
+    user_cache.put(user_id, record)
+
 def update_user_credits(user_id, amount):
     """Update user's credits"""
-    users_collection.update_one(
+    # The write returns the updated projection, which refreshes the cache without another read
+    record = users_collection.find_one_and_update(
         {'user_id': user_id},
-        {'$inc': {'credits': amount}}
+        {'$inc': {'credits': amount}},
+        projection=USER_PROFILE_PROJECTION,
+        return_document=ReturnDocument.AFTER
     )
+    if record:
+        cache_user_record(user_id, record)
+
+def apply_ledger_entry(user_id, amount, transaction_type, update_id, status='completed', min_credits=None):
+    """Change a user's credits and record the transaction atomically, at most once per update_id
+
+    Returns 'applied', 'duplicate' when this update was already applied (a journal replay),
+    or 'rejected' when the user doesn't exist or has fewer than min_credits.
+    """
+    # The transaction record and the credit change commit together, so an existing record
+    # means the credits have already moved
+    if transactions_collection.find_one({'update_id': update_id}, {'_id': 1}):
+        return 'duplicate'
+
+    query = {'user_id': user_id}
+    if min_credits is not None:
+        query['credits'] = {'$gte': min_credits}
+
+    def apply(session):
+        record = users_collection.find_one_and_update(
+            query,
+            {'$inc': {'credits': amount}},
+            projection=USER_PROFILE_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if record is None:
+            return None
+        transactions_collection.insert_one({
+            'user_id': user_id,
+            'type': transaction_type,
+            'amount': abs(amount),
+            'status': status,
+            'timestamp': utcnow(),
+            'update_id': update_id
+        }, session=session)
+        return record
+
+    try:
+        with client.start_session() as session:
+            record = session.with_transaction(apply)
+    except DuplicateKeyError:
+        # A concurrent delivery of the same update committed first
+        return 'duplicate'
+    if record is None:
+        return 'rejected'
+    cache_user_record(user_id, record)
+    return 'applied'
 
 def get_user(user_id):
     """Get user data"""
     return users_collection.find_one({'user_id': user_id})
 
+def get_user_profile(user_id):
+    """Get the cached profile projection of a user, or None if not registered"""
+    record = user_cache.get(user_id)
+    if record is UserCache.MISSING:
+        record = users_collection.find_one({'user_id': user_id}, USER_PROFILE_PROJECTION)
+        # Unknown users are not cached, they may register from another process at any time
+        if record is None:
+            return None
+        user_cache.put(user_id, record)
+    # Callers get a copy so they can never change the cached entry
+    return dict(record)
+
 def get_user_credits(user_id):
     """Get user's credits"""
-    user = get_user(user_id)
-    return user['credits'] if user else 0
+    user = get_user_profile(user_id)
+    return user.get('credits', 0) if user else 0
 
 def get_referral_count(user_id):
     """Get number of referrals for a user"""
-    return referral_history_collection.count_documents({'referrer_id': user_id})
+    record = get_user_profile(user_id)
+    if record and 'referral_count' in record:
+        return record['referral_count']
+    count = referral_history_collection.count_documents({'referrer_id': user_id})
+    if record:
+        user_cache.update(user_id, referral_count=count)
+    return count
+
+def get_usernames(user_ids):
+    """Get usernames for several users, reading uncached ones from a secondary in one query"""
+    usernames = {}
+    missing = []
+    for user_id in user_ids:
+        record = user_cache.get(user_id)
+        if record is UserCache.MISSING:
+            missing.append(user_id)
+        else:
+            usernames[user_id] = record.get('username')
+    if missing:
+        for user in users_secondary.find({'user_id': {'$in': missing}}, {'_id': 0, 'user_id': 1, 'username': 1}):
+            usernames[user['user_id']] = user.get('username')
+    return usernames
 
 def get_top_referrers(limit=10):
     """Get top referrers"""
@@ -178,7 +481,7 @@ def get_top_referrers(limit=10):
         {"$sort": {"count": -1}},
         {"$limit": limit}
     ]
-    return list(referral_history_collection.aggregate(pipeline))
+    return list(referral_history_secondary.aggregate(pipeline))
 
 def get_banned_users():
     """Get list of banned users"""
@@ -187,6 +490,7 @@ def get_banned_users():
 def reset_all_credits():
     """Reset all users' credits to zero"""
     users_collection.update_many({}, {'$set': {'credits': 0}})
+    user_cache.clear()
 
 def update_user_tier(user_id, tier):
     """Update user's tier"""
@@ -194,19 +498,20 @@ def update_user_tier(user_id, tier):
         {'user_id': user_id},
         {'$set': {'tier': tier}}
     )
+    user_cache.update(user_id, tier=tier)
 
 def update_user_activity(user_id):
     """Update user's last active time"""
     users_collection.update_one(
         {'user_id': user_id},
-        {'$set': {'last_active': datetime.now().isoformat()}}
+        {'$set': {'last_active': utcnow()}}
     )
 
 def update_referral_link_expiry(user_id, expiry_time):
     """Update referral link expiry time"""
     users_collection.update_one(
         {'user_id': user_id},
-        {'$set': {'referral_link_expiry': expiry_time.isoformat()}}
+        {'$set': {'referral_link_expiry': expiry_time}}
     )
 
 def ban_user(user_id):
@@ -215,6 +520,7 @@ def ban_user(user_id):
         {'user_id': user_id},
         {'$set': {'banned': True}}
     )
+    user_cache.update(user_id, banned=True)
 
 def unban_user(user_id):
     """Unban a user"""
@@ -222,6 +528,209 @@ def unban_user(user_id):
         {'user_id': user_id},
         {'$set': {'banned': False}}
     )
+    user_cache.update(user_id, banned=False)
+
+# === WITHDRAWAL SETTLEMENT ===
+PENDING_WITHDRAWALS = {'type': 'withdrawal', 'status': 'pending'}
+UNREFUNDED_WITHDRAWALS = {'type': 'withdrawal', 'status': 'rejected', 'refunded_at': None}
+
+def get_pending_withdrawals(limit=0):
+    """Get pending withdrawals, oldest first"""
+    return list(transactions_collection.find(PENDING_WITHDRAWALS).sort('timestamp', 1).limit(limit))
+
+def get_pending_withdrawal_summary():
+    """Count, total and oldest timestamp of pending withdrawals"""
+    pipeline = [
+        {"$match": PENDING_WITHDRAWALS},
+        {"$group": {
+            "_id": None,
+            "count": {"$sum": 1},
+            "total": {"$sum": "$amount"},
+            "oldest": {"$min": "$timestamp"}
+        }}
+    ]
+    return next(transactions_collection.aggregate(pipeline), None)
+
+def mark_withdrawals_digested(digested_at):
+    """Stamp pending withdrawals not yet reported to the admin, returns how many were new"""
+    return transactions_collection.update_many(
+        dict(PENDING_WITHDRAWALS, digested_at=None),
+        {'$set': {'digested_at': digested_at}}
+    ).modified_count
+
+def unmark_withdrawals_digested(digested_at):
+    """Undo a digest stamp so the next digest reports those withdrawals again"""
+    transactions_collection.update_many(
+        dict(PENDING_WITHDRAWALS, digested_at=digested_at),
+        {'$unset': {'digested_at': ''}}
+    )
+
+def settle_withdrawals(transaction_ids, status):
+    """Move pending withdrawals to `status` with a single bulk_write, returns the settled transactions"""
+    if not transaction_ids:
+        return []
+    # Tagging the batch lets us read back exactly the transactions this call settled,
+    # so a transaction is never settled twice
+    settlement_id = ObjectId()
+    operations = [
+        UpdateOne(
+            dict(PENDING_WITHDRAWALS, _id=transaction_id),
+            {'$set': {'status': status, 'settled_at': utcnow(), 'settlement_id': settlement_id}}
+        )
+        for transaction_id in transaction_ids
+    ]
+    transactions_collection.bulk_write(operations, ordered=False)
+    return list(transactions_collection.find({'settlement_id': settlement_id}))
+
+def refund_rejected_withdrawals():
+    """Refund every rejected, not yet refunded withdrawal in batches, returns totals per user
+
+    Each batch credits users with one bulk_write, records one refund per withdrawal with
+    insert_many and stamps refunded_at with update_many, all in one MongoDB transaction.
+    An interrupted run leaves whole batches refunded or untouched, and the next run
+    picks up the rest. Blocking: call it off the event loop. Callers must invalidate
+    the cached users it returns.
+    """
+    refunds = Counter()
+
+    def refund_batch(session):
+        # Read the batch inside the transaction: a concurrent run causes a write conflict,
+        # and the retried callback then sees the batch as already refunded
+        batch = list(transactions_collection.find(
+            UNREFUNDED_WITHDRAWALS, {'user_id': 1, 'amount': 1}, session=session
+        ).limit(REFUND_BATCH_SIZE))
+        totals = Counter()
+        for transaction in batch:
+            totals[transaction['user_id']] += transaction['amount']
+        if not batch:
+            return totals
+
+        now = utcnow()
+        users_collection.bulk_write(
+            [UpdateOne({'user_id': user_id}, {'$inc': {'credits': amount}}) for user_id, amount in totals.items()],
+            ordered=False,
+            session=session
+        )
+        transactions_collection.insert_many(
+            [
+                {
+                    'user_id': transaction['user_id'],
+                    'type': 'withdrawal_refund',
+                    'amount': transaction['amount'],
+                    'status': 'completed',
+                    'timestamp': now,
+                    'update_id': f"refund:{transaction['_id']}"
+                }
+                for transaction in batch
+            ],
+            ordered=False,
+            session=session
+        )
+        transactions_collection.update_many(
+            {'_id': {'$in': [transaction['_id'] for transaction in batch]}},
+            {'$set': {'refunded_at': now}},
+            session=session
+        )
+        return totals
+
+    while True:
+        with client.start_session() as session:
+            totals = session.with_transaction(refund_batch)
+        if not totals:
+            return refunds
+        refunds.update(totals)
+
+# === SCHEMA MIGRATION ===
+def legacy_documents_filter(collection_name):
+    """Match documents that still use the pre-version-2 layout"""
+    clauses = [{field: {'$type': 'string'}} for field in DATETIME_FIELDS[collection_name]]
+    if collection_name == 'users':
+        clauses.append({'schema_version': {'$ne': SCHEMA_VERSION}})
+    return {'$or': clauses}
+
+def migrate_batch(collection_name, after_id=None):
+    """Convert one batch of legacy documents in place, returns (scanned, modified, skipped, last_id)
+
+    Skipped documents were changed concurrently or hold unparseable timestamps and
+    keep their legacy layout.
+    """
+    collection = db[collection_name]
+    fields = DATETIME_FIELDS[collection_name]
+    is_users = collection_name == 'users'
+
+    query = legacy_documents_filter(collection_name)
+    if after_id is not None:
+        query = {'$and': [query, {'_id': {'$gt': after_id}}]}
+    projection = list(fields) + (['tier'] if is_users else [])
+    docs = list(collection.find(query, projection).sort('_id', 1).limit(MIGRATION_BATCH_SIZE))
+    if not docs:
+        return 0, 0, 0, after_id
+
+    operations = []
+    unparseable = 0
+    for doc in docs:
+        # Match on the values we read so a concurrent write is never overwritten;
+        # such documents keep their legacy layout and are picked up by the next run
+        match = {'_id': doc['_id']}
+        to_set = {}
+        to_unset = {}
+        parse_failed = False
+        for field in fields:
+            value = doc.get(field)
+            if is_users and field in doc and value is None:
+                match[field] = None
+                to_unset[field] = ''
+            elif isinstance(value, str):
+                try:
+                    to_set[field] = as_datetime(value)
+                    match[field] = value
+                except ValueError:
+                    parse_failed = True
+                    logger.warning(f"Skipping unparseable {collection_name}.{field} on {doc['_id']}: {value!r}")
+        if is_users:
+            if 'tier' in doc and doc['tier'] is None:
+                match['tier'] = None
+                to_unset['tier'] = ''
+            if not parse_failed:
+                to_set['schema_version'] = SCHEMA_VERSION
+        unparseable += parse_failed
+
+        update = {}
+        if to_set:
+            update['$set'] = to_set
+        if to_unset:
+            update['$unset'] = to_unset
+        if update:
+            operations.append(UpdateOne(match, update))
+
+    modified = 0
+    skipped = unparseable
+    if operations:
+        result = collection.bulk_write(operations, ordered=False)
+        modified = result.modified_count
+        skipped += len(operations) - result.matched_count
+    return len(docs), modified, skipped, docs[-1]['_id']
+
+async def run_schema_migration():
+    """Migrate all collections to the current schema in small batches, returns (modified, skipped) per collection"""
+    results = {}
+    for collection_name in DATETIME_FIELDS:
+        last_id = None
+        modified_total = 0
+        skipped_total = 0
+        while True:
+            # Run each batch off the event loop and pause between batches so the bot keeps serving updates
+            scanned, modified, skipped, last_id = await asyncio.to_thread(migrate_batch, collection_name, last_id)
+            modified_total += modified
+            skipped_total += skipped
+            if scanned < MIGRATION_BATCH_SIZE:
+                break
+            await asyncio.sleep(MIGRATION_BATCH_DELAY)
+        results[collection_name] = (modified_total, skipped_total)
+        logger.info(
+            f"Schema migration: {modified_total} documents updated, {skipped_total} skipped in {collection_name}"
+        )
+    return results
 
 # === FORCE JOIN FUNCTIONALITY ===
 async def is_user_member(user_id, bot):
@@ -279,7 +788,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             referrer_id = int(context.args[0])
             # Ensure the referrer exists and is not the same as the user
-            if referrer_id == user_id or not users_collection.find_one({'user_id': referrer_id}):
+            if referrer_id == user_id or not get_user_profile(referrer_id):
                 referrer_id = None
         except ValueError:
             referrer_id = None
@@ -289,22 +798,22 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if referrer_id:
         # Add referral record
-        add_referral(referrer_id, user_id)
+        add_referral(referrer_id, user_id, update.update_id)
         
         # Reward referrer with 10 UGX
-        update_user_credits(referrer_id, 10)
-        add_transaction(referrer_id, "referral_bonus", 10)
+        rewarded = apply_ledger_entry(referrer_id, 10, "referral_bonus", update.update_id)
         
-        # Notify referrer
-        try:
-            referred_username = user.username or f"User {user_id}"
-            await context.bot.send_message(
-                chat_id=referrer_id,
-                text=f"🎉 You have successfully referred {referred_username}! You earned **10 UGX**.",
-                parse_mode="Markdown"
-            )
-        except Exception as e:
-            logger.error(f"Failed to notify referrer {referrer_id}: {e}")
+        # Notify referrer, unless a journal replay already did
+        if rewarded == 'applied':
+            try:
+                referred_username = user.username or f"User {user_id}"
+                await context.bot.send_message(
+                    chat_id=referrer_id,
+                    text=f"🎉 You have successfully referred {referred_username}! You earned **10 UGX**.",
+                    parse_mode="Markdown"
+                )
+            except Exception as e:
+                logger.error(f"Failed to notify referrer {referrer_id}: {e}")
 
     # Generate referral link
     bot_username = (await context.bot.get_me()).username
@@ -329,23 +838,14 @@ async def credits(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /withdraw command"""
     user_id = update.effective_user.id
-    credits = get_user_credits(user_id)
 
-    if credits >= 500:
-        # Deduct 500 UGX
-        update_user_credits(user_id, -500)
-        add_transaction(user_id, "withdrawal", 500, "pending")
-        
-        # Notify admin
-        try:
-            await context.bot.send_message(
-                chat_id=CONFIG['admin_id'],
-                text=f"🚨 Withdrawal Request:\nUser ID: {user_id}\nAmount: 500 UGX"
-            )
-            await update.message.reply_text("✅ Your withdrawal request for 500 UGX has been submitted. The admin will process it shortly.")
-        except Exception as e:
-            logger.error(f"Failed to notify admin: {e}")
-            await update.message.reply_text("❌ Failed to process your withdrawal request. Please try again later.")
+    # Deduct 500 UGX and queue the pending withdrawal in one step; the balance check is part
+    # of the write, and a replayed update finds its withdrawal already queued
+    result = apply_ledger_entry(user_id, -500, "withdrawal", update.update_id, status="pending", min_credits=500)
+
+    if result != 'rejected':
+        # The admin is notified through the periodic withdrawal digest
+        await update.message.reply_text("✅ Your withdrawal request for 500 UGX has been submitted. The admin will process it shortly.")
     else:
         await update.message.reply_text("❌ You need at least 500 UGX to withdraw.")
 
@@ -357,12 +857,12 @@ async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ No data available for the leaderboard.")
         return
 
+    usernames = get_usernames([item['_id'] for item in top_referrers])
     leaderboard_text = "🏆 **Top Referrers:**\n\n"
     for i, item in enumerate(top_referrers, start=1):
         user_id = item['_id']
         count = item['count']
-        user = get_user(user_id)
-        username = user.get('username', f"User {user_id}") if user else f"User {user_id}"
+        username = usernames.get(user_id) or f"User {user_id}"
         leaderboard_text += f"{i}. {username}: {count} referrals\n"
 
     await update.message.reply_text(leaderboard_text, parse_mode="Markdown")
@@ -370,11 +870,9 @@ async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def redeem(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /redeem command"""
     user_id = update.effective_user.id
-    credits = get_user_credits(user_id)
+    result = apply_ledger_entry(user_id, -50, "redemption", update.update_id, min_credits=50)
 
-    if credits >= 50:
-        update_user_credits(user_id, -50)
-        add_transaction(user_id, "redemption", 50)
+    if result != 'rejected':
         await update.message.reply_text("🎉 You have successfully redeemed 50 UGX for rewards!")
     else:
         await update.message.reply_text("❌ You need at least 50 UGX to redeem rewards.")
@@ -383,7 +881,7 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /profile command"""
     user = update.effective_user
     user_id = user.id
-    user_data = get_user(user_id)
+    user_data = get_user_profile(user_id)
     
     if not user_data:
         await update.message.reply_text("❌ You are not registered in the system. Use /start to register.")
@@ -477,10 +975,20 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         }
     }]).next().get('total', 0)
 
+    cache_stats = user_cache.stats()
+    reads_per_command = ""
+    for command, calls in mongo_op_counter.invocations.most_common():
+        name = escape_markdown(command)
+        reads_per_call = mongo_op_counter.reads[command] / calls
+        reads_per_command += f"  - {name}: {reads_per_call:.2f} reads/call ({calls} calls)\n"
+
     stats_text = f"""
 📊 **Bot Statistics:**
 - Total Users: {total_users}
 - Total UGX: {total_credits}
+- User Cache: {cache_stats['size']} entries, {cache_stats['hit_rate']:.1%} hit rate ({cache_stats['hits']} hits, {cache_stats['misses']} misses)
+- MongoDB Reads per Command:
+{reads_per_command or "  - No commands handled yet"}
     """
     await update.message.reply_text(stats_text, parse_mode="Markdown")
 
@@ -497,8 +1005,9 @@ async def add_credits(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_user_id = int(context.args[0])
     credits_to_add = int(context.args[1])
 
-    update_user_credits(target_user_id, credits_to_add)
-    add_transaction(target_user_id, "admin_add", credits_to_add)
+    if apply_ledger_entry(target_user_id, credits_to_add, "admin_add", update.update_id) == 'rejected':
+        await update.message.reply_text(f"❌ User {target_user_id} not found.")
+        return
     await update.message.reply_text(f"✅ Added {credits_to_add} UGX to user {target_user_id}.")
 
 async def remove_credits(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -514,8 +1023,9 @@ async def remove_credits(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_user_id = int(context.args[0])
     credits_to_remove = int(context.args[1])
 
-    update_user_credits(target_user_id, -credits_to_remove)
-    add_transaction(target_user_id, "admin_remove", credits_to_remove)
+    if apply_ledger_entry(target_user_id, -credits_to_remove, "admin_remove", update.update_id) == 'rejected':
+        await update.message.reply_text(f"❌ User {target_user_id} not found.")
+        return
     await update.message.reply_text(f"✅ Removed {credits_to_remove} UGX from user {target_user_id}.")
 
 async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -604,8 +1114,7 @@ async def contest(update: Update, context: ContextTypes.DEFAULT_TYPE):
         top_referrer_id = top_referrer['_id']
         referrals_count = top_referrer['count']
         if referrals_count >= 100:
-            update_user_credits(top_referrer_id, 500)
-            add_transaction(top_referrer_id, "contest_reward", 500)
+            apply_ledger_entry(top_referrer_id, 500, "contest_reward", update.update_id)
             await update.message.reply_text(
                 f"🎉 User {top_referrer_id} has won the referral contest with {referrals_count} referrals and earned **500 UGX**!",
                 parse_mode="Markdown"
@@ -618,12 +1127,199 @@ async def contest(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("❌ No referrals have been made yet.")
 
+migration_task = None
+
+async def migrate_schema(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /migrateschema command"""
+    global migration_task
+    if update.effective_user.id != CONFIG['admin_id']:
+        await update.message.reply_text("❌ You don't have permission to use this command.")
+        return
+
+    if migration_task and not migration_task.done():
+        await update.message.reply_text("⏳ A schema migration is already running.")
+        return
+
+    async def migrate_and_report():
+        try:
+            results = await run_schema_migration()
+        except Exception as e:
+            logger.error(f"Schema migration failed: {e}")
+            await context.bot.send_message(chat_id=CONFIG['admin_id'], text=f"❌ Schema migration failed: {e}")
+            return
+        summary = "\n".join(
+            f"- {name}: {modified} updated, {skipped} skipped" for name, (modified, skipped) in results.items()
+        )
+        text = f"✅ Schema migration to version {SCHEMA_VERSION} finished:\n{summary}"
+        if any(skipped for _, skipped in results.values()):
+            text += "\n\n⚠️ Skipped documents changed during the run or have unparseable timestamps. Run /migrateschema again to retry them."
+        await context.bot.send_message(chat_id=CONFIG['admin_id'], text=text)
+
+    migration_task = context.application.create_task(migrate_and_report())
+    await update.message.reply_text(
+        f"🔄 Migrating documents to schema version {SCHEMA_VERSION} in batches of {MIGRATION_BATCH_SIZE}. "
+        "You will get a summary when it finishes."
+    )
+
+async def withdrawals(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /withdrawals command"""
+    if update.effective_user.id != CONFIG['admin_id']:
+        await update.message.reply_text("❌ You don't have permission to use this command.")
+        return
+
+    summary = get_pending_withdrawal_summary()
+    if not summary:
+        await update.message.reply_text("✅ There are no pending withdrawals.")
+        return
+
+    withdrawals_text = f"🧾 **Pending Withdrawals:** {summary['count']} ({summary['total']} UGX)\n\n"
+    for transaction in get_pending_withdrawals(WITHDRAWAL_LIST_LIMIT):
+        requested = as_datetime(transaction['timestamp'])
+        withdrawals_text += (
+            f"`{transaction['_id']}` - User {transaction['user_id']} - "
+            f"{transaction['amount']} UGX - {requested:%Y-%m-%d %H:%M}\n"
+        )
+    if summary['count'] > WITHDRAWAL_LIST_LIMIT:
+        withdrawals_text += f"...and {summary['count'] - WITHDRAWAL_LIST_LIMIT} more\n"
+    withdrawals_text += "\nUse /approve or /reject with transaction IDs or `all`."
+    await update.message.reply_text(withdrawals_text, parse_mode="Markdown")
+
+async def settle_withdrawals_command(update: Update, context: ContextTypes.DEFAULT_TYPE, status):
+    """Shared implementation of /approve and /reject"""
+    if update.effective_user.id != CONFIG['admin_id']:
+        await update.message.reply_text("❌ You don't have permission to use this command.")
+        return
+
+    command = "approve" if status == "approved" else "reject"
+    if not context.args:
+        await update.message.reply_text(f"❌ Usage: /{command} <transaction_id ...|all>")
+        return
+
+    if context.args[0].lower() == "all":
+        transaction_ids = await asyncio.to_thread(
+            lambda: [t['_id'] for t in transactions_collection.find(PENDING_WITHDRAWALS, {'_id': 1})]
+        )
+    else:
+        invalid = [arg for arg in context.args if not ObjectId.is_valid(arg)]
+        if invalid:
+            await update.message.reply_text(f"❌ Invalid transaction IDs: {', '.join(invalid)}")
+            return
+        transaction_ids = [ObjectId(arg) for arg in context.args]
+
+    # Large batches run off the event loop so webhook updates keep flowing
+    settled = await asyncio.to_thread(settle_withdrawals, transaction_ids, status)
+    if status == "rejected":
+        refunds = await complete_withdrawal_refunds()
+        await update.message.reply_text(
+            f"✅ Rejected {len(settled)} withdrawals and refunded {sum(refunds.values())} UGX "
+            f"to {len(refunds)} users."
+        )
+    else:
+        await update.message.reply_text(
+            f"✅ Approved {len(settled)} withdrawals totalling {sum(t['amount'] for t in settled)} UGX."
+        )
+
+    if len(settled) < len(transaction_ids):
+        await update.message.reply_text(
+            f"⚠️ {len(transaction_ids) - len(settled)} transactions were not pending and were skipped."
+        )
+
+    # Notify users in the background so large batches don't hold up other updates
+    context.application.create_task(notify_settled_withdrawals(context.bot, settled, status))
+
+async def approve(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /approve command"""
+    await settle_withdrawals_command(update, context, "approved")
+
+async def reject(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /reject command"""
+    await settle_withdrawals_command(update, context, "rejected")
+
+# === WITHDRAWAL SETTLEMENT TASKS ===
+async def complete_withdrawal_refunds():
+    """Refund rejected withdrawals off the event loop and drop the refunded users from the cache"""
+    refunds = await asyncio.to_thread(refund_rejected_withdrawals)
+    for user_id in refunds:
+        user_cache.invalidate(user_id)
+    return refunds
+
+async def notify_settled_withdrawals(bot, transactions, status):
+    """Tell users the outcome of their withdrawal requests"""
+    for transaction in transactions:
+        if status == "approved":
+            text = f"✅ Your withdrawal of {transaction['amount']} UGX has been approved."
+        else:
+            text = f"❌ Your withdrawal of {transaction['amount']} UGX was rejected and the amount has been refunded."
+        while True:
+            try:
+                await bot.send_message(chat_id=transaction['user_id'], text=text)
+            except RetryAfter as e:
+                # Flood control: wait as long as Telegram asks, then retry the same user
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                logger.error(f"Failed to notify user {transaction['user_id']} about withdrawal: {e}")
+            break
+        await asyncio.sleep(NOTIFICATION_DELAY)
+
+async def withdrawal_digest_loop(bot):
+    """Periodically send the admin a digest of pending withdrawals"""
+    while True:
+        await asyncio.sleep(WITHDRAWAL_DIGEST_MINUTES * 60)
+        try:
+            # Finish refunds interrupted by a crash during /reject
+            refunds = await complete_withdrawal_refunds()
+            if refunds:
+                logger.info(f"Completed {sum(refunds.values())} UGX of interrupted withdrawal refunds")
+
+            # New requests are the ones without a digest stamp, so nothing is missed across restarts
+            digested_at = utcnow()
+            new = await asyncio.to_thread(mark_withdrawals_digested, digested_at)
+            if not new:
+                continue
+            summary = await asyncio.to_thread(get_pending_withdrawal_summary)
+            if not summary:
+                # Everything was settled in the meantime
+                continue
+            oldest = as_datetime(summary['oldest'])
+            try:
+                await bot.send_message(
+                    chat_id=CONFIG['admin_id'],
+                    text=(
+                        f"🧾 Withdrawal digest: {new} new requests.\n"
+                        f"Pending: {summary['count']} totalling {summary['total']} UGX "
+                        f"(oldest {oldest:%Y-%m-%d %H:%M} UTC).\n"
+                        "Use /withdrawals to review, /approve or /reject to settle."
+                    )
+                )
+            except Exception:
+                await asyncio.to_thread(unmark_withdrawals_digested, digested_at)
+                raise
+        except Exception as e:
+            logger.error(f"Failed to send withdrawal digest: {e}")
+
+digest_task = None
+
+async def start_background_tasks(application):
+    """Start long-running tasks once the application is initialized"""
+    global digest_task
+    digest_task = asyncio.create_task(withdrawal_digest_loop(application.bot))
+
+async def stop_background_tasks(application):
+    """Cancel long-running tasks on shutdown"""
+    if digest_task:
+        digest_task.cancel()
+        try:
+            await digest_task
+        except asyncio.CancelledError:
+            pass
+
 # === UTILITY FUNCTIONS ===
 async def generate_referral_link(user_id, context):
     """Generate referral link with expiry"""
     bot_username = (await context.bot.get_me()).username
     referral_link = f"https://t.me/{bot_username}?start={user_id}"
-    expiry_time = datetime.now() + timedelta(hours=48)
+    expiry_time = utcnow() + timedelta(hours=48)
     update_referral_link_expiry(user_id, expiry_time)
     return referral_link
 
@@ -631,8 +1327,8 @@ async def notify_referral_link_expiry(user_id, context):
     """Notify user about expiring referral link"""
     user = get_user(user_id)
     if user and user.get('referral_link_expiry'):
-        expiry_time = datetime.fromisoformat(user['referral_link_expiry'])
-        if (expiry_time - datetime.now()).total_seconds() <= 3600:
+        expiry_time = as_datetime(user['referral_link_expiry'])
+        if (expiry_time - utcnow()).total_seconds() <= 3600:
             await context.bot.send_message(
                 chat_id=user_id,
                 text="⚠️ Your referral link is about to expire in 1 hour. Generate a new one using /referrallink."
@@ -658,8 +1354,8 @@ async def track_user_activity(user_id, context):
     update_user_activity(user_id)
     user = get_user(user_id)
     if user and user.get('last_active'):
-        last_active = datetime.fromisoformat(user['last_active'])
-        if (datetime.now() - last_active).days >= 3:
+        last_active = as_datetime(user['last_active'])
+        if (utcnow() - last_active).days >= 3:
             await context.bot.send_message(
                 chat_id=user_id,
                 text="👋 You haven't been active for 3 days. Come back and earn more UGX!"
@@ -677,6 +1373,169 @@ async def check_milestone_rewards(user_id, context):
             parse_mode="Markdown"
         )
 
+# === UPDATE JOURNAL ===
+class UpdateJournal:
+    """Append-only segment files recording webhook updates until they are processed
+
+    Each segment holds one JSON record per line: ``{"id": ..., "update": ...}`` when an
+    update is accepted and ``{"ack": ...}`` once its handlers have run. Appends are made
+    durable with a group commit, so concurrent requests share a single fsync. A segment
+    is deleted once every update recorded in it has been acknowledged.
+    """
+
+    def __init__(self, directory, segment_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.seen = {}        # update_id -> segment holding its update record
+        self.pending = {}     # segment -> update_ids not yet acknowledged
+        self.recorded = {}    # segment -> all update_ids recorded in it
+        self.active = None
+        self.active_seq = 0
+        self.active_size = 0
+        self.waiters = []
+        self.flush_task = None
+        self.acks_unsynced = False
+
+    def _path(self, seq):
+        return os.path.join(self.directory, f"{seq:012d}.seg")
+
+    def recover(self):
+        """Load existing segments and return unacknowledged updates in arrival order"""
+        os.makedirs(self.directory, exist_ok=True)
+        unprocessed = {}
+        segments = sorted(
+            int(name[:-4]) for name in os.listdir(self.directory)
+            if name.endswith('.seg') and name[:-4].isdigit()
+        )
+        for seq in segments:
+            self.pending[seq] = set()
+            self.recorded[seq] = set()
+            valid_bytes = 0
+            with open(self._path(seq), 'rb') as f:
+                for line in f:
+                    # A torn write from a crash leaves a partial last line
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    valid_bytes += len(line)
+                    if 'ack' in record:
+                        seq_of_update = self.seen.get(record['ack'])
+                        if seq_of_update is not None:
+                            self.pending[seq_of_update].discard(record['ack'])
+                        unprocessed.pop(record['ack'], None)
+                    elif record['id'] not in self.seen:
+                        self.seen[record['id']] = seq
+                        self.pending[seq].add(record['id'])
+                        self.recorded[seq].add(record['id'])
+                        unprocessed[record['id']] = record['update']
+            if valid_bytes < os.path.getsize(self._path(seq)):
+                logger.warning(f"Truncating torn tail of journal segment {seq}")
+                os.truncate(self._path(seq), valid_bytes)
+
+        self.active_seq = (segments[-1] if segments else 0) + 1
+        self._open_active()
+        self._compact()
+        if unprocessed:
+            logger.info(f"Replaying {len(unprocessed)} unprocessed updates from the journal")
+        return list(unprocessed.values())
+
+    def _open_active(self):
+        self.active = open(self._path(self.active_seq), 'ab')
+        self.active_size = 0
+        self.pending[self.active_seq] = set()
+        self.recorded[self.active_seq] = set()
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(',', ':')).encode() + b'\n'
+        self.active.write(line)
+        self.active_size += len(line)
+
+    async def append(self, update_id, data):
+        """Durably record an update, returns False if this update_id was already accepted"""
+        if update_id in self.seen:
+            return False
+        seq = self.active_seq
+        self.seen[update_id] = seq
+        self.pending[seq].add(update_id)
+        self.recorded[seq].add(update_id)
+        self._write({'id': update_id, 'update': data})
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self._schedule_flush()
+        try:
+            await waiter
+        except OSError:
+            # Forget the update so Telegram's retry is journaled again instead of being deduplicated
+            self.seen.pop(update_id, None)
+            self.pending[seq].discard(update_id)
+            self.recorded[seq].discard(update_id)
+            raise
+        return True
+
+    def _schedule_flush(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        """Group commit: fsync once for every append and ack written since the previous fsync"""
+        while self.waiters or self.acks_unsynced:
+            waiters, self.waiters = self.waiters, []
+            self.acks_unsynced = False
+            try:
+                self.active.flush()
+                await asyncio.to_thread(os.fsync, self.active.fileno())
+            except OSError as e:
+                logger.error(f"Failed to sync update journal: {e}")
+                for waiter in waiters:
+                    waiter.set_exception(e)
+                continue
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            # Only roll when nothing written to the current segment is still waiting for its fsync
+            if not self.waiters and self.active_size >= self.segment_bytes:
+                self.active.close()
+                self.active_seq += 1
+                self._open_active()
+                self._compact()
+
+    def ack(self, update_id):
+        """Mark an update as processed and drop segments that are fully processed"""
+        seq = self.seen.get(update_id)
+        if seq is None or update_id not in self.pending[seq]:
+            return
+        self.pending[seq].discard(update_id)
+        self._write({'ack': update_id})
+        # Hand the ack to the OS right away so it survives a process kill, and fsync it with
+        # the next group commit. Only a host crash in that window replays the update, and the
+        # money-moving writes are keyed by update_id so a replay can't apply them twice.
+        self.active.flush()
+        self.acks_unsynced = True
+        self._schedule_flush()
+        self._compact()
+
+    def _compact(self):
+        for seq in [seq for seq, ids in self.pending.items() if not ids and seq != self.active_seq]:
+            os.remove(self._path(seq))
+            del self.pending[seq]
+            for update_id in self.recorded.pop(seq):
+                # A retried update may have been journaled again in a newer segment
+                if self.seen.get(update_id) == seq:
+                    del self.seen[update_id]
+
+    def close(self):
+        if self.active:
+            self.active.flush()
+            os.fsync(self.active.fileno())
+            self.active.close()
+            self.active = None
+
+update_journal = UpdateJournal(JOURNAL_DIR, JOURNAL_SEGMENT_BYTES)
+
 # === WEBHOOK SETUP ===
 async def health_check(request):
     """Health check endpoint"""
@@ -684,16 +1543,63 @@ async def health_check(request):
 
 async def telegram_webhook(request):
     """Handle incoming webhook requests"""
-    update = Update.de_json(await request.json(), application.bot)
-    await application.update_queue.put(update)
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403)
+
+    data = await request.json()
+    update = Update.de_json(data, application.bot)
+    # Journal before answering so Telegram's 200 OK never covers an update we could lose;
+    # a failed append returns 500 and Telegram retries the delivery
+    if await update_journal.append(update.update_id, data):
+        await application.update_queue.put(update)
     return web.Response(text="OK")
 
+async def acknowledge_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mark an update as processed in the journal once all handlers have run"""
+    update_journal.ack(update.update_id)
+
+async def run_webhook_server():
+    """Serve the webhook, replaying journaled updates that were not processed before a restart"""
+    unprocessed = update_journal.recover()
+
+    web_app = web.Application()
+    web_app.router.add_get('/', health_check)
+    web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    runner = web.AppRunner(web_app)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async with application:
+        # post_init only runs under run_polling/run_webhook, so start the tasks ourselves
+        await start_background_tasks(application)
+        await application.start()
+        for data in unprocessed:
+            await application.update_queue.put(Update.de_json(data, application.bot))
+
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', PORT).start()
+        await application.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+        logger.info(f"Webhook server listening on port {PORT}")
+
+        try:
+            await stop_event.wait()
+        finally:
+            await runner.cleanup()
+            await stop_background_tasks(application)
+            await application.stop()
+            update_journal.close()
+
 def main():
     """Run the bot"""
     global application
-    application = Application.builder().token(CONFIG['token']).build()
+    ensure_indexes()
+    application = Application.builder().token(CONFIG['token']).post_init(start_background_tasks).post_shutdown(stop_background_tasks).build()
 
     # Add command handlers
+    application.add_handler(TypeHandler(Update, tag_command), group=COMMAND_TAG_GROUP)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("credits", credits))
     application.add_handler(CommandHandler("withdraw", withdraw))
@@ -714,16 +1620,20 @@ def main():
     application.add_handler(CommandHandler("listbanned", list_banned))
     application.add_handler(CommandHandler("resetleaderboard", reset_leaderboard))
     application.add_handler(CommandHandler("contest", contest))
+    application.add_handler(CommandHandler("migrateschema", migrate_schema))
+    application.add_handler(CommandHandler("withdrawals", withdrawals))
+    application.add_handler(CommandHandler("approve", approve))
+    application.add_handler(CommandHandler("reject", reject))
     application.add_handler(CallbackQueryHandler(verify_membership, pattern="^verify_membership$"))
+    registered_commands.update(
+        command for handler in application.handlers[0] if isinstance(handler, CommandHandler)
+        for command in handler.commands
+    )
 
     # Start the bot with webhook if running on Render
     if os.getenv('RENDER'):
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path=WEBHOOK_PATH,
-            webhook_url=WEBHOOK_URL
-        )
+        application.add_handler(TypeHandler(Update, acknowledge_update), group=JOURNAL_ACK_GROUP)
+        asyncio.run(run_webhook_server())
     else:
         application.run_polling()
 